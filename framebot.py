@@ -1,29 +1,135 @@
 #%%
 import configparser
+import errno
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
 import os
 import facebook
 import time
 from datetime import datetime
-import json
-from PIL import Image, ImageOps
+import orjson
 import shutil
 from random import random
 from io import BytesIO
 import platform
+import re
+import string
 import sys
 
-def safe_json_dump(fpath, jsoncontent):
+FILENAME_CHARS = frozenset(string.ascii_letters + string.digits + "._- ")
+FILENAME_TABLE = {c: None for c in range(128) if chr(c) not in FILENAME_CHARS}
+OLD_QUEUE_FORMAT = re.compile(rb'\s*\{\s*"list"\s*:')
+LINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP)
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP)
+created_dirs = set()
+
+
+def safe_write(fpath, content):
     safe_path = fpath + "_safe"
-    with open(safe_path, "w") as f:
-        json.dump(jsoncontent, f, indent=4)
-    shutil.move(safe_path, fpath)
+    with open(safe_path, "wb") as f:
+        f.write(content)
+    os.replace(safe_path, fpath)
+
+
+def dump_json_lines(fpath, entries):
+    safe_write(fpath, b"".join(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in entries))
+
+
+def load_json_lines(fpath):
+    with open(fpath, "rb") as f:
+        content = f.read()
+    if OLD_QUEUE_FORMAT.match(content):
+        return orjson.loads(content)["list"]
+    lines = content.splitlines()
+    entries = []
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            entries.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            if i < len(lines) - 1:
+                raise
+            print(f"The last line of {fpath} is incomplete, probably because the bot was stopped while writing it. Skipping it...")
+    return entries
+
+
+def fast_copy(src, dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    safe_path = dst + "_safe"
+    with open(src, "rb") as fsrc, open(safe_path, "wb") as fdst:
+        copied = False
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                copied = True
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+        if not copied:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst)
+    os.replace(safe_path, dst)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        fast_copy(src, dst)
+    except OSError as e:
+        if e.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+        fast_copy(src, dst)
+
+
+def wait_and_report(futures):
+    for future in futures:
+        if future.exception() is not None:
+            print(future.exception())
+    futures.clear()
+
+
+def sanitize_filename(name):
+    if name.isascii():
+        return name.translate(FILENAME_TABLE)
+    return "".join(x for x in name if x.isalnum() or x in "._- ")
+
+
+def mirror_line(line):
+    if len(line) < 2:
+        return line
+    left = line[:(len(line) + 1) // 2]
+    return left + left[len(line) // 2 - 1::-1]
+
+
+def mirror_image(image_path):
+    from PIL import Image
+    im = Image.open(image_path)
+    half_width = im.size[0] // 2
+    im.paste(im.crop((0, 0, half_width, im.size[1])).transpose(Image.FLIP_LEFT_RIGHT), (half_width, 0))
+    image_file = BytesIO()
+    im.save(image_file, "jpeg")
+    return image_file.getvalue()
 
 
 def get_filename(full_path):
     return full_path[full_path.rfind(os.path.sep) + 1:]
 
+
+def makedirs_once(path):
+    if path not in created_dirs:
+        os.makedirs(path, exist_ok=True)
+        created_dirs.add(path)
+
 class SingleVideoFrameBot:
+    BEST_OF_MESSAGE = "Reactions after {hours} hours: {reactions}.\nOriginal post: https://facebook.com/{post_id}\n\n{description}"
+
     def __init__(self, access_token, page_id, movie_title, mirroring_enabled=False,
                  mirror_photos_album_id=None, mirroring_ratio=0.5, best_of_reposting_enabled=False,
                   best_of_reactions_threshold=0, best_of_album_id=None, best_of_wait_hours=24,
@@ -36,23 +142,38 @@ class SingleVideoFrameBot:
         self.graph = facebook.GraphAPI(access_token)
         self.mirroring_enabled = mirroring_enabled
         if self.mirroring_enabled:
+            if not 0 <= mirroring_ratio <= 100:
+                raise ValueError(f"Mirroring ratio must be a percentage between 0 and 100, got {mirroring_ratio}.")
             self.mirroring_ratio = mirroring_ratio
+            self.mirroring_probability = mirroring_ratio / 100
             self.mirror_photos_album_id = mirror_photos_album_id
+            self.mirroring_pool = ProcessPoolExecutor(max_workers=1)
         self.best_of_reposting_enabled = best_of_reposting_enabled
         if self.best_of_reposting_enabled:
             self.best_of_to_check_file = best_of_to_check_file
+            self.best_of_head_file = best_of_to_check_file + "_head"
+            self.best_of_last_checked = None
             if os.path.exists(self.best_of_to_check_file):
                 print(f"Found existing {self.best_of_to_check_file} files for best of checks, trying to load it...")
-                with open(best_of_check_file) as f:
-                    self.best_of_to_check = json.load(f)
+                entries = load_json_lines(self.best_of_to_check_file)
+                if os.path.exists(self.best_of_head_file):
+                    with open(self.best_of_head_file) as f:
+                        last_checked = f.read()
+                    post_ids = [entry["post_id"] for entry in entries]
+                    if last_checked in post_ids:
+                        entries = entries[post_ids.index(last_checked) + 1:]
+                self.best_of_to_check = deque(entries)
+                dump_json_lines(self.best_of_to_check_file, self.best_of_to_check)
             else:
-                self.best_of_to_check = {"list": []}
+                self.best_of_to_check = deque()
+            self.best_of_log = open(self.best_of_to_check_file, "ab", buffering=0)
+            self.best_of_log_length = len(self.best_of_to_check)
             self.best_of_reactions_threshold = best_of_reactions_threshold
             self.best_of_wait_hours = best_of_wait_hours
             self.best_of_album_id = best_of_album_id
-            self.best_of_local_dir = os.path.join("albums", "".join(x for x in f"Bestof_{self.movie_title.replace(os.path.sep, '-')}" if (x.isalnum()) or x in "._- "))
+            self.best_of_local_dir = os.path.join("albums", sanitize_filename(f"Bestof_{self.movie_title.replace(os.path.sep, '-')}"))
             print(f"Best ofs will be saved locally in the directory {self.best_of_local_dir}.")
-            os.makedirs(self.best_of_local_dir, exist_ok=True)
+            makedirs_once(self.best_of_local_dir)
         self.frames_directory = frames_directory
         self.frames_ext = frames_ext
         self.frames = glob(os.path.join(frames_directory, f"*.{self.frames_ext}"))
@@ -98,19 +219,10 @@ class SingleVideoFrameBot:
                 retry_count += 1
         return page_post_id
 
-    def post_mirror_frame(self, image_path, og_message):
-        im = Image.open(image_path)
-        flippedhalf = ImageOps.mirror(im.crop((0, 0, im.size[0] // 2, im.size[1])))
-        im.paste(flippedhalf, (im.size[0] // 2, 0))
-        image_file = BytesIO()
-        im.save(image_file, "jpeg")
-        lines = og_message.split("\n")
-        message = ""
-        for line in lines:
-            message += line[:len(line) // 2] + line[len(line) // 2::-1] + "\n"
-
+    def post_mirror_frame(self, image_data, og_message):
+        message = "".join(mirror_line(line) + "\n" for line in og_message.split("\n"))
         message += f"\nJust a randomly mirrored image.\n-{self.bot_name}"
-        self.upload_photo(image_file, message, self.mirror_photos_album_id)
+        self.upload_photo(BytesIO(image_data), message, self.mirror_photos_album_id)
 
     def get_frame_index_number(self, file_name):
             return int(file_name[:file_name.find(".")])
@@ -118,46 +230,75 @@ class SingleVideoFrameBot:
     def get_default_message(self, frame_number):
         return f"{self.movie_title}\nFrame {frame_number} of {self.total_frames_number}"
 
+    def queue_for_best_of(self, entry):
+        self.best_of_to_check.append(entry)
+        self.best_of_log.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+        self.best_of_log_length += 1
+
+    def save_best_of_progress(self):
+        safe_write(self.best_of_head_file, self.best_of_last_checked.encode())
+        if self.best_of_log_length > 2 * len(self.best_of_to_check):
+            self.best_of_log.close()
+            dump_json_lines(self.best_of_to_check_file, self.best_of_to_check)
+            self.best_of_log = open(self.best_of_to_check_file, "ab", buffering=0)
+            self.best_of_log_length = len(self.best_of_to_check)
+
+    def store_checked_frame(self, frame_path, best_of_path=None):
+        if best_of_path is not None:
+            if self.delete_files:
+                link_or_copy(frame_path, best_of_path)
+            else:
+                fast_copy(frame_path, best_of_path)
+        if self.delete_files:
+            os.remove(frame_path)
+
     def advance_bests(self):
         print(f"Checking for best of reuploading...")
         checked_all = False
         modified = False
+        now = datetime.now()
+        pending_io = []
         try:
-            while (not checked_all) and len(self.best_of_to_check["list"]) > 0:
-                frame_to_check = self.best_of_to_check["list"][0]
-                timestamp = datetime.fromisoformat(frame_to_check["time"])
-                elapsed_hours = ((datetime.now() - timestamp).total_seconds() // 3600)
-                if elapsed_hours < self.best_of_wait_hours:
-                    checked_all = True
-                else:
-                    print(f"Checking entry {frame_to_check}...")
-                    page_story_id = self.graph.get_object(frame_to_check["post_id"], fields="page_story_id")["page_story_id"]
-                    reactions = self.graph.get_object(id=page_story_id, fields="reactions.summary(total_count)")["reactions"]["summary"]["total_count"]
-                    if reactions > self.best_of_reactions_threshold:
-                        print(f"Uploading frame {frame_to_check['path']} to best of album...")
-                        message = f"Reactions after {int(elapsed_hours)} hours: {reactions}.\n" + \
-                                  f"Original post: https://facebook.com/{frame_to_check['post_id']}\n\n" + \
-                                  self.get_default_message(frame_to_check['frame_number'])
-                        if os.path.exists(frame_to_check["path"]):
-                            self.upload_photo(frame_to_check["path"], message, frame_to_check["album_id"])
-                            shutil.copyfile(frame_to_check["path"],
-                                            os.path.join(self.best_of_local_dir,
-                                                         f"Frame {frame_to_check['frame_number']} "
-                                                         f"id {frame_to_check['post_id']} "
-                                                         f"reactions {reactions}.jpg"))
-                            print("Done.\n")
-                        else:
-                            print(f"File {frame_to_check['path']} is missing. Skipping uploading to best of album...")
-                    if self.delete_files:
-                        os.remove(frame_to_check["path"])
-                    self.best_of_to_check["list"].pop(0)
-                    safe_json_dump(self.best_of_to_check_file, self.best_of_to_check)
-                    modified = True
+            with ThreadPoolExecutor(max_workers=1) as local_io:
+                while (not checked_all) and len(self.best_of_to_check) > 0:
+                    frame_to_check = self.best_of_to_check[0]
+                    timestamp = datetime.fromisoformat(frame_to_check["time"])
+                    elapsed_hours = ((now - timestamp).total_seconds() // 3600)
+                    if elapsed_hours < self.best_of_wait_hours:
+                        checked_all = True
+                    else:
+                        print(f"Checking entry {frame_to_check}...")
+                        page_story_id = self.graph.get_object(frame_to_check["post_id"], fields="page_story_id")["page_story_id"]
+                        reactions = self.graph.get_object(id=page_story_id, fields="reactions.summary(total_count)")["reactions"]["summary"]["total_count"]
+                        wait_and_report(pending_io)
+                        if modified:
+                            self.save_best_of_progress()
+                            modified = False
+                        best_of_path = None
+                        if reactions > self.best_of_reactions_threshold:
+                            print(f"Uploading frame {frame_to_check['path']} to best of album...")
+                            message = self.BEST_OF_MESSAGE.format(hours=int(elapsed_hours), reactions=reactions,
+                                                                  post_id=frame_to_check['post_id'],
+                                                                  description=self.get_default_message(frame_to_check['frame_number']))
+                            if os.path.exists(frame_to_check["path"]):
+                                self.upload_photo(frame_to_check["path"], message, frame_to_check["album_id"])
+                                best_of_path = os.path.join(self.best_of_local_dir,
+                                                            f"Frame {frame_to_check['frame_number']} "
+                                                            f"id {frame_to_check['post_id']} "
+                                                            f"reactions {reactions}.jpg")
+                                print("Done.\n")
+                            else:
+                                print(f"File {frame_to_check['path']} is missing. Skipping uploading to best of album...")
+                        pending_io.append(local_io.submit(self.store_checked_frame, frame_to_check["path"], best_of_path))
+                        self.best_of_to_check.popleft()
+                        self.best_of_last_checked = frame_to_check["post_id"]
+                        modified = True
         except Exception as e:
             print(e)
         finally:
+            wait_and_report(pending_io)
             if modified:
-                safe_json_dump(self.best_of_to_check_file, self.best_of_to_check)
+                self.save_best_of_progress()
         print("Done checking for best ofs.\n")
 
     def start_upload(self):
@@ -171,6 +312,10 @@ class SingleVideoFrameBot:
 
             print(f"Uploading frame {frame_number} of {self.total_frames_number}...")
 
+            mirror_job = None
+            if self.mirroring_enabled and random() < self.mirroring_probability:
+                mirror_job = self.mirroring_pool.submit(mirror_image, frame)
+
             message = self.get_default_message(frame_number)
             post_id = self.upload_photo(frame, message)
 
@@ -180,26 +325,29 @@ class SingleVideoFrameBot:
 
             if self.best_of_reposting_enabled:
                 print(f"Queueing frame {frame_number} for best of checking...")
-                self.best_of_to_check["list"].append(
+                self.queue_for_best_of(
                     {"time": str(datetime.now()), "post_id": post_id, "path": frame,
-                     "album_id": best_of_album_id, "frame_number": frame_number})
-                safe_json_dump(self.best_of_to_check_file, self.best_of_to_check)
-            if self.mirroring_enabled and random() > (1 - self.mirroring_ratio / 100):
+                     "album_id": self.best_of_album_id, "frame_number": frame_number})
+            if mirror_job is not None:
                 print("Posting mirrored frame...")
-                self.post_mirror_frame(frame, message)
+                self.post_mirror_frame(mirror_job.result(), message)
             print(f"Uploaded.\nWaiting {self.upload_interval} seconds before the next one...\n")
             if self.delete_files and not self.best_of_reposting_enabled:
                 os.remove(frame)
             time.sleep(self.upload_interval)
 
+        if self.mirroring_enabled:
+            self.mirroring_pool.shutdown()
+
         if self.best_of_reposting_enabled:
             self.best_of_wait_hours = self.best_of_wait_hours // 2
-            while self.best_of_to_check['list']:
+            while self.best_of_to_check:
                 self.advance_bests()
-                if self.best_of_to_check['list']:
+                if self.best_of_to_check:
                     print(
-                        f"There are still {len(self.best_of_to_check['list'])} frames to check for best of. Sleeping for one hour...")
+                        f"There are still {len(self.best_of_to_check)} frames to check for best of. Sleeping for one hour...")
                     time.sleep(3600)
+            self.best_of_log.close()
 
                 
 #%%